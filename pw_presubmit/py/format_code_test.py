@@ -0,0 +1,298 @@
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for pw_presubmit.format_code."""
+
+import mmap
+import os
+from pathlib import Path
+import shutil
+import tempfile
+from typing import List
+import unittest
+from unittest import mock
+
+from pw_presubmit import format_code
+
+# These tests cover format_code's internal helpers.
+# pylint: disable=protected-access
+
+
+class TestInlineClangFormatStyle(unittest.TestCase):
+    """Tests converting .clang-format files to inline --style arguments."""
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _inline_style(self, contents):
+        style_file = os.path.join(self.test_dir, '.clang-format')
+        with open(style_file, 'w') as fd:
+            fd.write(contents)
+
+        return format_code._inline_clang_format_style(style_file)
+
+    def test_flat_options(self):
+        self.assertEqual(
+            self._inline_style('# Comment\n'
+                               'BasedOnStyle: Google\n'
+                               '\n'
+                               'ColumnLimit: 80\n'),
+            '--style={BasedOnStyle: Google, ColumnLimit: 80}')
+
+    def test_trailing_comments_are_dropped(self):
+        self.assertEqual(
+            self._inline_style('BasedOnStyle: Google  # Base style\n'
+                               'ColumnLimit: 80\t# Line length\n'),
+            '--style={BasedOnStyle: Google, ColumnLimit: 80}')
+
+    def test_nested_options(self):
+        self.assertIsNone(
+            self._inline_style('BasedOnStyle: Google\n'
+                               'BraceWrapping:\n'
+                               '  AfterClass: true\n'))
+
+    def test_multiple_documents(self):
+        self.assertIsNone(
+            self._inline_style('---\n'
+                               'BasedOnStyle: Google\n'
+                               '...\n'))
+
+    def test_quoted_values(self):
+        self.assertIsNone(
+            self._inline_style("CommentPragmas: '^ IWYU pragma:'\n"))
+        self.assertIsNone(self._inline_style('CommentPragmas: "# NOLINT"\n'))
+
+    def test_flow_values(self):
+        self.assertIsNone(
+            self._inline_style('ForEachMacros: [foreach, BOOST_FOREACH]\n'))
+
+
+def _lines(count: int, text: bytes = b'int value = 1;') -> bytes:
+    return b''.join(b'%s  // %d\n' % (text, i) for i in range(count))
+
+
+def _diverges_substantially(original, formatted) -> bool:
+    return format_code._diverges_substantially(
+        original, formatted,
+        *format_code._common_affix_lengths(original, formatted))
+
+
+class TestDivergesSubstantially(unittest.TestCase):
+    """Tests deciding whether to summarize rather than diff a file."""
+    def test_small_fixes_at_both_ends_are_diffed(self):
+        original = b'int  first;\n' + _lines(10000) + b'int  last;\n'
+        formatted = b'int first;\n' + _lines(10000) + b'int last;\n'
+        self.assertGreater(len(original), format_code._LARGE_FILE_SIZE)
+
+        self.assertFalse(_diverges_substantially(original, formatted))
+
+    def test_large_size_change_is_summarized(self):
+        original = _lines(10000)
+        self.assertTrue(_diverges_substantially(original, original * 3))
+
+    def test_large_changed_region_is_summarized(self):
+        original = _lines(20000)
+        formatted = _lines(20000, b'int VALUE = 1;')
+        self.assertEqual(len(original), len(formatted))
+
+        self.assertTrue(_diverges_substantially(original, formatted))
+
+    def test_mapped_file(self):
+        original = b'int  first;\n' + _lines(10000)
+        with tempfile.TemporaryFile() as fd:
+            fd.write(original)
+            fd.flush()
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.assertFalse(
+                    _diverges_substantially(
+                        data, original.replace(b'int  ', b'int ', 1)))
+
+
+class TestCommonAffixLength(unittest.TestCase):
+    """Tests finding the common start and end of two buffers."""
+    def test_prefix(self):
+        size = format_code._COMPARED_CHUNK_SIZE
+        data = bytes(range(256)) * (3 * size // 256)
+
+        for position in (0, 1, size - 1, size, size + 1, len(data) - 1):
+            changed = data[:position] + b'!' + data[position + 1:]
+            self.assertEqual(format_code._common_prefix_length(data, changed),
+                             position)
+
+        self.assertEqual(format_code._common_prefix_length(data, data[:10]),
+                         10)
+
+    def test_suffix(self):
+        size = format_code._COMPARED_CHUNK_SIZE
+        data = bytes(range(256)) * (3 * size // 256)
+
+        for position in (0, 1, size - 1, size, size + 1, len(data) - 1):
+            changed = data[:-position - 1] + b'!' + data[len(data) - position:]
+            self.assertEqual(
+                format_code._common_suffix_length(data, changed, len(data)),
+                position)
+
+    def test_suffix_limit(self):
+        self.assertEqual(format_code._common_suffix_length(b'aaaa', b'aa', 1),
+                         1)
+
+
+def _full_diff(original: bytes, formatted: bytes) -> str:
+    return format_code._colorize_diff_lines(
+        format_code._unified_diff(format_code._decode_lines(original),
+                                  format_code._decode_lines(formatted),
+                                  'file.cc  (original)',
+                                  'file.cc  (reformatted)'))
+
+
+class TestDiff(unittest.TestCase):
+    """Tests diffing files and their formatted versions."""
+    def test_offset_hunk_header(self):
+        self.assertEqual(
+            format_code._offset_hunk_header('@@ -1,4 +1,5 @@\n', 10),
+            '@@ -11,4 +11,5 @@\n')
+        self.assertEqual(format_code._offset_hunk_header('@@ -3 +3,0 @@\n', 7),
+                         '@@ -10 +10,0 @@\n')
+        self.assertEqual(
+            format_code._offset_hunk_header('@@ -0,0 +1,2 @@ int main()\n', 5),
+            '@@ -5,0 +6,2 @@ int main()\n')
+
+    def test_offset_hunk_header_ignores_other_lines(self):
+        for line in ('--- file.cc  (original)\n', '-@@ -1,2 +1,2 @@\n',
+                     ' @@ -1 +1 @@\n', '+int x;\n'):
+            self.assertEqual(format_code._offset_hunk_header(line, 10), line)
+
+    def test_small_file(self):
+        original = _lines(100)
+        formatted = original.replace(b'= 1', b'=1')
+
+        self.assertEqual(
+            format_code._diff_contents('file.cc', original, formatted),
+            _full_diff(original, formatted))
+
+    def test_unchanged_file(self):
+        original = _lines(10000)
+        self.assertIsNone(
+            format_code._diff_contents('file.cc', original, original))
+
+    def test_trimmed_diff_matches_full_diff(self):
+        original = _lines(10000)
+        formatted = original.replace(b'value = 1;  // 3000\n',
+                                     b'value=1;  // 3000\n').replace(
+                                         b'  // 7000\n', b'  // 7000\n\n')
+        self.assertGreater(len(original), format_code._LARGE_FILE_SIZE)
+
+        self.assertEqual(
+            format_code._diff_contents('file.cc', original, formatted),
+            _full_diff(original, formatted))
+
+    def test_changes_at_start_and_end(self):
+        original = b'int  first;\n' + _lines(10000) + b'int  last;'
+        formatted = b'int first;\n' + _lines(10000) + b'int last;\n'
+
+        self.assertEqual(
+            format_code._diff_contents('file.cc', original, formatted),
+            _full_diff(original, formatted))
+
+    def test_line_numbers_count_all_line_breaks(self):
+        original = (_lines(3000).replace(b'\n', b'\r\n') +
+                    _lines(3000).replace(b'\n', b'\r') + _lines(3000))
+        formatted = original.replace(b'value = 1;  // 2000\n',
+                                     b'value=1;  // 2000\n')
+
+        self.assertEqual(
+            format_code._diff_contents('file.cc', original, formatted),
+            _full_diff(original, formatted))
+
+    def test_mapped_file(self):
+        original = _lines(10000)
+        formatted = original.replace(b'  // 5000\n', b' // 5000\n')
+
+        with tempfile.TemporaryFile() as fd:
+            fd.write(original)
+            fd.flush()
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                self.assertEqual(
+                    format_code._diff_contents('file.cc', data, formatted),
+                    _full_diff(original, formatted))
+                self.assertIsNone(
+                    format_code._diff_contents('file.cc', data, original))
+
+
+def _format_lowercase(_, data) -> bytes:
+    return bytes(data).lower()
+
+
+_FORMATTER = format_code._FormatterId(('nonexistent-formatter', ))
+
+
+class TestFormatCache(unittest.TestCase):
+    """Tests skipping files that already passed a check."""
+    def setUp(self):
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.path = self.test_dir / 'file.txt'
+
+        patches = (
+            mock.patch.object(format_code, '_CACHE_DIR',
+                              self.test_dir / 'cache'),
+            mock.patch.dict(format_code._FORMAT_CACHES, clear=True),
+        )
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.checked: List[Path] = []
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _check_batch(self, files):
+        self.assertTrue(files)
+        self.checked.extend(files)
+        return format_code._diff_formatted_files(_format_lowercase, files)
+
+    def _check(self):
+        return format_code._check_files(_FORMATTER, [self.path],
+                                        self._check_batch,
+                                        jobs=1)
+
+    def test_clean_file_is_not_checked_again(self):
+        self.path.write_bytes(b'clean\n')
+        self.assertEqual(self._check(), {})
+        self.assertEqual(self.checked, [self.path])
+
+        self.assertEqual(self._check(), {})
+        self.assertEqual(self.checked, [self.path])
+
+    def test_file_with_errors_is_checked_again(self):
+        self.path.write_bytes(b'BAD\n')
+        self.assertIn(self.path, self._check())
+        self.assertIn(self.path, self._check())
+        self.assertEqual(self.checked, [self.path, self.path])
+
+    def test_edit_with_same_size_and_mtime_is_checked(self):
+        self.path.write_bytes(b'clean\n')
+        stat = self.path.stat()
+        self.assertEqual(self._check(), {})
+
+        self.path.write_bytes(b'BAD!!\n')
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        self.assertEqual(self.path.stat().st_size, stat.st_size)
+
+        self.assertIn(self.path, self._check())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -21,15 +21,29 @@ code. These tools must be available on the path when this script is invoked!
 
 import argparse
 import collections
-import difflib
+import functools
+import hashlib
+import json
 import logging
+import mmap
+import multiprocessing
 import os
 from pathlib import Path
 import re
+import shutil
 import subprocess
 import sys
-from typing import Callable, Collection, Dict, Iterable, List, NamedTuple
-from typing import Optional, Sequence
+import tempfile
+import time
+from typing import Callable, Collection, Dict, FrozenSet, Iterable, List
+from typing import NamedTuple, Optional, Sequence, Set, Tuple, Union
+from xml.etree import ElementTree
+
+try:
+    # difflib_rs is an optional, faster drop-in for difflib's unified_diff.
+    from difflib_rs import unified_diff as _unified_diff
+except ImportError:
+    from difflib import unified_diff as _unified_diff
 
 try:
     import pw_presubmit
@@ -40,91 +54,684 @@ except ImportError:
         os.path.abspath(__file__))))
     import pw_presubmit
 
-from pw_presubmit import file_summary, list_git_files, log_run, plural
+from pw_presubmit import file_summary, list_git_files, log_command, log_run
+from pw_presubmit import plural
 
 _LOG: logging.Logger = logging.getLogger(__name__)
 
+_COLOR_BY_PREFIX: Dict[str, Callable[[str], str]] = {
+    '-': pw_presubmit.color_red,
+    '+': pw_presubmit.color_green,
+    '@': pw_presubmit.color_aqua,
+}
+
 
 def _colorize_diff_line(line: str) -> str:
-    if line.startswith('--- ') or line.startswith('+++ '):
+    prefix = line[:1]
+    if prefix in '-+' and line[:4] in ('--- ', '+++ '):
         return pw_presubmit.color_bold_white(line)
-    if line.startswith('-'):
-        return pw_presubmit.color_red(line)
-    if line.startswith('+'):
-        return pw_presubmit.color_green(line)
-    if line.startswith('@@ '):
-        return pw_presubmit.color_aqua(line)
-    return line
+
+    color = _COLOR_BY_PREFIX.get(prefix)
+    return color(line) if color else line
+
+
+def _colorize_diff_lines(lines: Iterable[str]) -> str:
+    return ''.join(map(_colorize_diff_line, lines))
+
+
+def colorize_diff_text(text: str) -> str:
+    """Takes a diff str and returns a colorized version."""
+    return _colorize_diff_lines(text.splitlines(True))
 
 
 def colorize_diff(lines: Iterable[str]) -> str:
     """Takes a diff str or list of str lines and returns a colorized version."""
     if isinstance(lines, str):
-        lines = lines.splitlines(True)
+        return colorize_diff_text(lines)
 
-    return ''.join(_colorize_diff_line(line) for line in lines)
+    return _colorize_diff_lines(lines)
 
 
-def _diff(path, original: bytes, formatted: bytes) -> str:
-    return colorize_diff(
-        difflib.unified_diff(
-            original.decode(errors='replace').splitlines(True),
-            formatted.decode(errors='replace').splitlines(True),
-            f'{path}  (original)', f'{path}  (reformatted)'))
+# File contents, which may be mapped into memory rather than read.
+Contents = Union[bytes, mmap.mmap]
 
+Formatter = Callable[[str, Contents], bytes]
 
-Formatter = Callable[[str, bytes], bytes]
+# Files at least this large are mapped into memory instead of read into a copy.
+# If they differ from their formatted versions, only the changed region is
+# decoded and diffed, and they are summarized if that region is very large.
+# Work proportional to the whole file is negligible for smaller files.
+_LARGE_FILE_SIZE = 64 * 1024
 
 
 def _diff_formatted(path, formatter: Formatter) -> Optional[str]:
     """Returns a diff comparing a file to its formatted version."""
     with open(path, 'rb') as fd:
-        original = fd.read()
+        if os.fstat(fd.fileno()).st_size < _LARGE_FILE_SIZE:
+            original: Contents = fd.read()
+            return _diff_contents(path, original, formatter(path, original))
+
+        with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as original:
+            return _diff_contents(path, original, formatter(path, original))
+
+
+# Diffing large changed regions is very slow and produces diffs too large to
+# read, so files with such changes are summarized instead. Only the region
+# between the unchanged start and end of the file counts, so small fixes at
+# both ends of a large file are still diffed.
+_MAX_DIFFED_SIZE_CHANGE = 256 * 1024
+_MAX_DIFFED_REGION_SIZE = 256 * 1024
+
+
+# Files are compared in chunks of this size to find where they differ. bytes
+# compare with memcmp, but memoryviews are compared element by element, which
+# is far too slow for large files.
+_COMPARED_CHUNK_SIZE = 64 * 1024
+
+
+def _chunk_prefix_length(first: bytes, second: bytes) -> int:
+    low, high = 0, min(len(first), len(second))
+
+    while low < high:
+        mid = (low + high + 1) // 2
+        if first[:mid] == second[:mid]:
+            low = mid
+        else:
+            high = mid - 1
+
+    return low
+
+
+def _common_prefix_length(first: Contents, second: Contents) -> int:
+    """Returns the length of the common start of two buffers."""
+    length = min(len(first), len(second))
+
+    for start in range(0, length, _COMPARED_CHUNK_SIZE):
+        end = min(start + _COMPARED_CHUNK_SIZE, length)
+        first_chunk, second_chunk = first[start:end], second[start:end]
+        if first_chunk != second_chunk:
+            return start + _chunk_prefix_length(first_chunk, second_chunk)
+
+    return length
+
+
+def _common_suffix_length(first: Contents, second: Contents,
+                          limit: int) -> int:
+    """Returns the length, up to limit, of the common end of two buffers."""
+    length = min(len(first), len(second), limit)
+
+    for start in range(0, length, _COMPARED_CHUNK_SIZE):
+        end = min(start + _COMPARED_CHUNK_SIZE, length)
+        first_chunk = first[len(first) - end:len(first) - start]
+        second_chunk = second[len(second) - end:len(second) - start]
+        if first_chunk != second_chunk:
+            return start + _chunk_prefix_length(first_chunk[::-1],
+                                                second_chunk[::-1])
+
+    return length
+
+
+def _common_affix_lengths(first: Contents,
+                          second: Contents) -> Tuple[int, int]:
+    """Returns the lengths of the common start and end of two buffers.
+
+    The common end never overlaps the common start.
+    """
+    prefix = _common_prefix_length(first, second)
+    limit = min(len(first), len(second)) - prefix
+    return prefix, _common_suffix_length(first, second, limit)
+
+
+def _diverges_substantially(original: Contents, formatted: bytes, prefix: int,
+                            suffix: int) -> bool:
+    """Checks if the changed region of a file is too big to diff.
+
+    prefix and suffix are the lengths of the unchanged start and end.
+    """
+    if abs(len(formatted) - len(original)) > _MAX_DIFFED_SIZE_CHANGE:
+        return True
+
+    changed = max(len(original), len(formatted)) - prefix - suffix
+    return changed > _MAX_DIFFED_REGION_SIZE
+
+
+# The number of unchanged lines unified_diff shows around each change.
+_DIFF_CONTEXT_LINES = 3
+
+# Trimmed diffs keep this many unchanged lines around the changed region. This
+# is more than the diff shows, so that difflib has room to place changes among
+# repeated lines as it would in the full file.
+_TRIMMED_CONTEXT_LINES = _DIFF_CONTEXT_LINES + 20
+
+
+def _context_start(data: Contents, position: int) -> int:
+    """Finds where the unchanged lines kept before a position begin."""
+    start = data.rfind(b'\n', 0, position) + 1
+
+    for _ in range(_TRIMMED_CONTEXT_LINES):
+        if start == 0:
+            break
+        start = data.rfind(b'\n', 0, start - 1) + 1
+
+    return start
+
+
+def _context_end(data: Contents, position: int) -> int:
+    """Finds where the unchanged lines kept after a position end."""
+    end = position
+
+    for _ in range(_TRIMMED_CONTEXT_LINES + 1):
+        end = data.find(b'\n', end) + 1
+        if end == 0:
+            return len(data)
+
+    return end
+
+
+def _count_line_breaks(data: Contents, end: int) -> int:
+    """Counts the line breaks before end, as splitlines finds them."""
+    count = 0
+
+    # Count in chunks to avoid copying all of the data.
+    for start in range(0, end, _COMPARED_CHUNK_SIZE):
+        chunk_end = min(start + _COMPARED_CHUNK_SIZE, end)
+        chunk = data[start:chunk_end]
+        count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+
+        # Count a \r\n split between two chunks only once.
+        if chunk_end < end and data[chunk_end - 1:chunk_end + 1] == b'\r\n':
+            count -= 1
+
+    return count
+
+
+def _offset_hunk_header(line: str, offset: int) -> str:
+    """Shifts the line numbers in a unified diff @@ line by an offset."""
+    if not line.startswith('@@ '):
+        return line
+
+    _, *ranges, rest = line.split(' ', 3)
+
+    shifted = []
+    for side in ranges:
+        start, separator, length = side[1:].partition(',')
+        shifted.append(f'{side[0]}{int(start) + offset}{separator}{length}')
+
+    return ' '.join(['@@', *shifted, rest])
+
+
+def _decode_lines(data: bytes) -> List[str]:
+    # Line endings are ASCII, so decoding line by line gives the same result as
+    # decoding all at once.
+    return [str(line, 'utf-8', 'replace') for line in data.splitlines(True)]
+
+
+def _diff(path,
+          original: Contents,
+          formatted: bytes,
+          prefix: int = 0,
+          suffix: int = 0) -> str:
+    """Returns a colorized unified diff of a file and its formatted version.
+
+    prefix and suffix are the lengths of the unchanged start and end of the
+    file. Only the lines between them, plus some unchanged lines around them,
+    are decoded and diffed, and the line numbers in the diff are adjusted for
+    the skipped lines. The diff is always correct, but where changes are among
+    repeated lines, difflib may place them differently than it would in a diff
+    of the full file.
+    """
+    start = _context_start(original, prefix)
+    original_end = _context_end(original, len(original) - suffix)
+    formatted_end = original_end - len(original) + len(formatted)
+
+    lines = _unified_diff(_decode_lines(original[start:original_end]),
+                          _decode_lines(formatted[start:formatted_end]),
+                          f'{path}  (original)', f'{path}  (reformatted)')
+
+    skipped_lines = _count_line_breaks(original, start)
+    return _colorize_diff_lines(
+        _offset_hunk_header(line, skipped_lines) for line in lines)
+
+
+def _diff_contents(path, original: Contents,
+                   formatted: bytes) -> Optional[str]:
+    # bytes compare with memcmp. Mapped files never compare equal to bytes, so
+    # they are compared in chunks below.
+    if isinstance(original, bytes) and original == formatted:
+        return None
+
+    # Small files are always diffed in full.
+    if len(original) < _LARGE_FILE_SIZE:
+        return _diff(path, original, formatted)
+
+    prefix, suffix = _common_affix_lengths(original, formatted)
+    if prefix == len(original) == len(formatted):
+        return None
+
+    if _diverges_substantially(original, formatted, prefix, suffix):
+        return _colorize_diff_lines([
+            f'--- {path}  (original)\n',
+            f'+++ {path}  (reformatted)\n',
+        ]) + pw_presubmit.color_yellow(
+            'The formatted file differs substantially from the original; '
+            'the diff is omitted.\n')
+
+    return _diff(path, original, formatted, prefix, suffix)
+
+
+def _diff_formatted_files(formatter: Formatter,
+                          files: Iterable) -> Dict[Path, str]:
+    """Formats and diffs each file; returns {path: diff} for bad files."""
+    diffs = {path: _diff_formatted(path, formatter) for path in files}
+    return {path: diff for path, diff in diffs.items() if diff}
+
+
+# Checks the formatting of a batch of files; returns {path: diff} for files with
+# bad formatting.
+BatchCheck = Callable[[Sequence], Dict[Path, str]]
+
+# Checking only a few files isn't worth the cost of starting worker processes.
+_MIN_FILES_FOR_POOL = 5
+
+
+def _default_jobs() -> int:
+    """Returns the number of CPUs available to this process."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # sched_getaffinity isn't available on all systems.
+        return os.cpu_count() or 1
+
+
+class _FormatCache:
+    """Records files that passed a format check.
+
+    Entries are keyed by a hash of the formatter's executable and version, the
+    contents of the config files that apply to the file, and the file's path
+    and contents. A file is only checked again if any of these change. Entries
+    that haven't been used for a while are dropped.
+    """
+    def __init__(self, path: Path, max_age_s: float):
+        self._path = path
+        self._max_age_s = max_age_s
+        self._entries: Optional[Dict[str, float]] = None
+        self._modified = False
+
+    def _load(self) -> Dict[str, float]:
+        if self._entries is None:
+            try:
+                with self._path.open() as fd:
+                    entries = json.load(fd)
+            except (OSError, ValueError):
+                entries = {}
+
+            oldest = time.time() - self._max_age_s
+            self._entries = {
+                key: timestamp
+                for key, timestamp in entries.items() if timestamp > oldest
+            }
+
+        return self._entries
+
+    def keys(self) -> FrozenSet[str]:
+        return frozenset(self._load())
+
+    def update(self, keys: Iterable[str]) -> None:
+        """Adds entries or marks them as used."""
+        entries = self._load()
+        now = time.time()
+        for key in keys:
+            if key not in entries:
+                self._modified = True
+            entries[key] = now
+
+    def flush(self) -> None:
+        """Writes the cache to disk if anything was added."""
+        if not self._modified:
+            return
+
+        try:
+            self._path.parent.mkdir(parents=True, exist_ok=True)
+            with self._path.open('w') as fd:
+                json.dump(self._entries, fd)
+            self._modified = False
+        except OSError as err:
+            _LOG.debug('Failed to write format cache %s: %s', self._path, err)
+
+
+_CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache'))
+
+# Format caches by repository root.
+_FORMAT_CACHES: Dict[str, _FormatCache] = {}
+
+
+@functools.lru_cache()
+def _repository_root(directory: str) -> str:
+    if pw_presubmit.is_git_repo(directory):
+        return str(pw_presubmit.git_repo_path(repo=directory))
+    return directory
+
+
+def _format_cache() -> _FormatCache:
+    """Returns the format cache for the repository in the working directory."""
+    root = _repository_root(os.getcwd())
+
+    if root not in _FORMAT_CACHES:
+        name = hashlib.blake2b(root.encode(), digest_size=8).hexdigest()
+        _FORMAT_CACHES[root] = _FormatCache(
+            _CACHE_DIR / 'pw_presubmit' / 'format_cache_v2' / f'{name}.json',
+            max_age_s=7 * 24 * 60 * 60)
+
+    return _FORMAT_CACHES[root]
+
+
+def _flush_format_caches() -> None:
+    for cache in _FORMAT_CACHES.values():
+        cache.flush()
+
+
+class _FormatterId(NamedTuple):
+    """Identifies a formatter for the format cache."""
+    # Command that prints the formatter's version. The first argument must be
+    # the formatter's executable.
+    version_command: Tuple[str, ...]
+
+    # Config files the formatter looks for in a file's directory and parents.
+    config_files: Tuple[str, ...] = ()
+
+
+_CLANG_FORMAT_ID = _FormatterId(('clang-format', '--version'),
+                                ('.clang-format', '_clang-format'))
+_GN_FORMAT_ID = _FormatterId(('gn', '--version'))
+# gofmt has no version option; it is identified by its executable alone.
+_GOFMT_ID = _FormatterId(('gofmt', ))
+_YAPF_ID = _FormatterId(('python', '-m', 'yapf', '--version'),
+                        ('.style.yapf', 'setup.cfg', 'pyproject.toml'))
+
+
+@functools.lru_cache()
+def _formatter_version(version_command: Tuple[str, ...]) -> str:
+    """Describes a formatter's executable and version."""
+    executable = shutil.which(version_command[0])
+    if executable is None:
+        return ''
+
+    stat = os.stat(executable)
+    description = f'{executable}\0{stat.st_mtime_ns}\0{stat.st_size}\0'
+
+    if len(version_command) > 1:
+        try:
+            description += subprocess.run(version_command,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.STDOUT,
+                                          check=True).stdout.decode(
+                                              errors='replace')
+        except (OSError, subprocess.CalledProcessError) as err:
+            _LOG.debug('Failed to get the version of %s: %s', executable, err)
+
+    return description
+
+
+@functools.lru_cache(maxsize=None)
+def _config_digest(directory: str, config_files: Tuple[str, ...]) -> str:
+    """Hashes the config files in a directory and all of its parents."""
+    digest = hashlib.blake2b(digest_size=16)
+
+    parent = os.path.dirname(directory)
+    if parent != directory:
+        digest.update(_config_digest(parent, config_files).encode())
+
+    for name in config_files:
+        try:
+            with open(os.path.join(directory, name), 'rb') as fd:
+                digest.update(name.encode() + b'\0' + fd.read())
+        except OSError:
+            continue
+
+    return digest.hexdigest()
+
+
+def _cache_key_prefix(formatter: _FormatterId, path) -> bytes:
+    """Hashes everything in a file's cache key except its contents."""
+    path = os.path.abspath(path)
+
+    digest = hashlib.blake2b(
+        _formatter_version(formatter.version_command).encode(),
+        digest_size=16)
+    if formatter.config_files:
+        digest.update(
+            _config_digest(os.path.dirname(path),
+                           formatter.config_files).encode())
+    digest.update(path.encode())
+    return digest.digest()
+
+
+def _cache_key(path, prefix: bytes) -> str:
+    """Returns a file's cache key, which includes a hash of its contents."""
+    digest = hashlib.blake2b(prefix, digest_size=16)
+
+    with open(path, 'rb') as fd:
+        if os.fstat(fd.fileno()).st_size < _LARGE_FILE_SIZE:
+            digest.update(fd.read())
+        else:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                digest.update(data)
+
+    return digest.hexdigest()
+
+
+# Cache keys of files that already passed the check being run. Each worker
+# process gets a copy when it starts.
+_CLEAN_KEYS: FrozenSet[str] = frozenset()
+
+
+def _set_clean_keys(keys: FrozenSet[str]) -> None:
+    global _CLEAN_KEYS  # pylint: disable=global-statement
+    _CLEAN_KEYS = keys
+
+
+def _check_uncached_batch(
+        check_batch: BatchCheck,
+        batch: Sequence) -> Tuple[Dict[Path, str], List[str]]:
+    """Checks the files in a batch that haven't already passed the check.
+
+    The batch is a list of (path, cache key prefix) pairs. Returns {path: diff}
+    for files with bad formatting and the cache keys of the files that passed.
+    """
+    keys = {path: _cache_key(path, prefix) for path, prefix in batch}
 
-    formatted = formatter(path, original)
+    unchecked = [path for path, key in keys.items() if key not in _CLEAN_KEYS]
+    errors = check_batch(unchecked) if unchecked else {}
 
-    return None if formatted == original else _diff(path, original, formatted)
+    failed = set(str(path) for path in errors)
+    return errors, [
+        key for path, key in keys.items() if str(path) not in failed
+    ]
 
 
-def _check_files(files, formatter: Formatter) -> Dict[Path, str]:
-    errors = {}
+def _check_files(formatter: _FormatterId,
+                 files: Iterable,
+                 check_batch: BatchCheck,
+                 jobs: Optional[int] = None,
+                 batch_size: int = 1) -> Dict[Path, str]:
+    """Runs check_batch on batches of files; returns {path: diff} for bad files.
 
-    for path in files:
-        difference = _diff_formatted(path, formatter)
-        if difference:
-            errors[path] = difference
+    Batches are checked in worker processes, which hash the files and check
+    only those that haven't already passed, then return the rendered diffs.
+    The files are spread evenly across the jobs, in batches of at most
+    batch_size files. check_batch must be a module-level function, or a
+    functools.partial of one, so that it can be passed to the workers.
+    """
+    work = [(path, _cache_key_prefix(formatter, path)) for path in files]
+    if not work:
+        return {}
+
+    # Don't start more workers than there are files to check.
+    jobs = min(_default_jobs() if jobs is None else jobs, len(work))
+
+    size = min(batch_size, -(-len(work) // jobs))
+    batches = [work[i:i + size] for i in range(0, len(work), size)]
+
+    cache = _format_cache()
+    check = functools.partial(_check_uncached_batch, check_batch)
+    errors: Dict[Path, str] = {}
+
+    def add_results(results: Iterable) -> None:
+        for batch_errors, clean_keys in results:
+            errors.update(batch_errors)
+            cache.update(clean_keys)
+
+    if len(work) < _MIN_FILES_FOR_POOL or jobs <= 1:
+        _set_clean_keys(cache.keys())
+        add_results(map(check, batches))
+    else:
+        chunksize = max(1, len(batches) // (4 * jobs))
+        with multiprocessing.Pool(jobs, _set_clean_keys,
+                                  (cache.keys(), )) as pool:
+            add_results(pool.imap_unordered(check, batches, chunksize))
 
     return errors
 
 
-def _clang_format(*args: str, **kwargs) -> bytes:
-    return log_run('clang-format',
-                   '--style=file',
-                   *args,
-                   stdout=subprocess.PIPE,
-                   check=True,
-                   **kwargs).stdout
+def _run_silent(command: Tuple[str, ...], **kwargs) -> bytes:
+    """Runs a formatter and returns its output, without logging the command.
+
+    This is used for commands run for every file, which would flood the logs.
+    """
+    return subprocess.run(command,
+                          stdout=subprocess.PIPE,
+                          check=True,
+                          **kwargs).stdout
+
+
+_CLANG_FORMAT_BASE = ('clang-format', '--style=file')
+
+
+def _clang_format(*args: str,
+                  base: Tuple[str, ...] = _CLANG_FORMAT_BASE,
+                  **kwargs) -> bytes:
+    return _run_silent(base + args, **kwargs)
+
+
+# clang-format commands by directory. Each process finds and reads a
+# directory's .clang-format file only once, rather than once per command.
+_CLANG_FORMAT_COMMANDS: Dict[str, Tuple[str, ...]] = {}
+
+
+def _inline_clang_format_style(style_file: str) -> Optional[str]:
+    """Converts a .clang-format file to an inline --style argument.
+
+    Only files with one top-level option per line are converted. Returns None
+    for files with nested options or multiple documents. Trailing comments are
+    dropped; files with quoted or flow style values, which may hold characters
+    that would break the inline mapping, also return None.
+    """
+    options = []
+
+    with open(style_file) as fd:
+        for line in fd:
+            line = re.sub(r'\s+#.*', '', line).rstrip()
+            if not line or line.startswith('#'):
+                continue
+
+            if line[0] in ' \t-.' or ':' not in line:
+                return None
+
+            if any(char in line for char in '#\'"{}[],'):
+                return None
+
+            options.append(line)
+
+    return '--style={' + ', '.join(options) + '}'
+
+
+def _clang_format_command(directory: str) -> Tuple[str, ...]:
+    """Returns the clang-format command for files in the directory."""
+    command = _CLANG_FORMAT_COMMANDS.get(directory)
+
+    if command is None:
+        for name in ('.clang-format', '_clang-format'):
+            style_file = os.path.join(directory, name)
+            if os.path.isfile(style_file):
+                style = _inline_clang_format_style(style_file)
+                command = (('clang-format', style)
+                           if style else _CLANG_FORMAT_BASE)
+                break
+        else:
+            parent = os.path.dirname(directory)
+            command = (_CLANG_FORMAT_BASE if parent == directory else
+                       _clang_format_command(parent))
 
+        _CLANG_FORMAT_COMMANDS[directory] = command
 
-def check_c_format(files: Iterable[Path]) -> Dict[Path, str]:
+    return command
+
+
+def _clang_format_file(path, data: Contents) -> bytes:
+    # Pass the contents through stdin so the file is only read once.
+    return _clang_format(f'--assume-filename={path}',
+                         base=_clang_format_command(
+                             os.path.dirname(os.path.abspath(path))),
+                         input=data)
+
+
+# Limit the files per clang-format command to stay well under ARG_MAX.
+_CLANG_FORMAT_BATCH_SIZE = 200
+
+
+def _clang_format_changes(files: Sequence) -> List:
+    """Returns the files that clang-format would change.
+
+    Rather than starting clang-format once per file, this lists the changes for
+    all of the files with --output-replacements-xml.
+    """
+    # clang-format prints a separate XML document for each file, in order.
+    documents = _clang_format('--output-replacements-xml',
+                              *files).split(b'<?xml')[1:]
+
+    if len(documents) != len(files):
+        _LOG.debug('Unexpected clang-format output; checking all files')
+        return list(files)
+
+    changed: List = []
+
+    for path, document in zip(files, documents):
+        replacements = ElementTree.fromstring(b'<?xml' + document)
+        if replacements.find('replacement') is not None:
+            changed.append(path)
+
+    return changed
+
+
+def _check_c_batch(files: Sequence) -> Dict[Path, str]:
+    return _diff_formatted_files(_clang_format_file,
+                                 _clang_format_changes(files))
+
+
+def check_c_format(files: Iterable[Path],
+                   jobs: Optional[int] = None) -> Dict[Path, str]:
     """Checks formatting; returns {path: diff} for files with bad formatting."""
-    return _check_files(files, lambda path, _: _clang_format(path))
+    return _check_files(_CLANG_FORMAT_ID, files, _check_c_batch, jobs,
+                        _CLANG_FORMAT_BATCH_SIZE)
 
 
 def fix_c_format(files: Iterable) -> None:
     """Fixes formatting for the provided files in place."""
-    _clang_format('-i', *files)
+    log_run(*_CLANG_FORMAT_BASE, '-i', *files, check=True)
+
+
+_GN_FORMAT_STDIN = ('gn', 'format', '--stdin')
+
+
+def _gn_format(_, data: Contents) -> bytes:
+    return _run_silent(_GN_FORMAT_STDIN, input=data)
 
 
-def check_gn_format(files: Iterable[Path]) -> Dict[Path, str]:
+def check_gn_format(files: Iterable[Path],
+                    jobs: Optional[int] = None) -> Dict[Path, str]:
     """Checks formatting; returns {path: diff} for files with bad formatting."""
-    return _check_files(
-        files, lambda _, data: log_run('gn',
-                                       'format',
-                                       '--stdin',
-                                       input=data,
-                                       stdout=subprocess.PIPE,
-                                       check=True).stdout)
+    return _check_files(_GN_FORMAT_ID, files,
+                        functools.partial(_diff_formatted_files, _gn_format),
+                        jobs)
 
 
 def fix_gn_format(files: Iterable[Path]) -> None:
@@ -132,48 +739,84 @@ def fix_gn_format(files: Iterable[Path]) -> None:
     log_run('gn', 'format', *files, check=True)
 
 
-def check_go_format(files: Iterable[Path]) -> Dict[Path, str]:
+_GOFMT = ('gofmt', )
+
+
+def _gofmt(_, data: Contents) -> bytes:
+    return _run_silent(_GOFMT, input=data)
+
+
+def check_go_format(files: Iterable[Path],
+                    jobs: Optional[int] = None) -> Dict[Path, str]:
     """Checks formatting; returns {path: diff} for files with bad formatting."""
-    return _check_files(
-        files, lambda path, _: log_run(
-            'gofmt', path, stdout=subprocess.PIPE, check=True).stdout)
+    return _check_files(_GOFMT_ID, files,
+                        functools.partial(_diff_formatted_files, _gofmt), jobs)
 
 
 def fix_go_format(files: Iterable[Path]) -> None:
     """Fixes formatting for the provided files in place."""
-    log_run('gofmt', '-w', *files, check=True)
+    log_run(*_GOFMT, '-w', *files, check=True)
+
+
+_YAPF = ('python', '-m', 'yapf')
 
 
 def _yapf(*args, **kwargs) -> subprocess.CompletedProcess:
-    return log_run('python',
-                   '-m',
-                   'yapf',
-                   '--parallel',
-                   *args,
-                   capture_output=True,
-                   **kwargs)
+    return log_run(*_YAPF, '--parallel', *args, capture_output=True, **kwargs)
 
 
-_DIFF_START = re.compile(r'^--- (.*)\s+\(original\)$', flags=re.MULTILINE)
+_DIFF_START = re.compile(br'^--- (.*)\s+\(original\)$')
 
 
-def check_py_format(files: Iterable[Path]) -> Dict[Path, str]:
+def check_py_format(files: Iterable[Path],
+                    jobs: Optional[int] = None) -> Dict[Path, str]:
     """Checks formatting; returns {path: diff} for files with bad formatting."""
-    process = _yapf('--diff', *files)
+    return _check_files(_YAPF_ID, files, _check_py_batch, jobs,
+                        _YAPF_BATCH_SIZE)
 
+
+# Each yapf command checks up to this many files. Rather than starting its own
+# workers with --parallel, yapf runs once per batch in the worker pool, which
+# limits it to the number of jobs.
+_YAPF_BATCH_SIZE = 200
+
+
+def _check_py_batch(files: Sequence) -> Dict[Path, str]:
     errors: Dict[Path, str] = {}
 
-    if process.stdout:
-        raw_diff = process.stdout.decode(errors='replace')
+    def add_error(path: Optional[Path], lines: List[str]) -> None:
+        if path is not None:
+            errors[path] = _colorize_diff_lines(lines)
+
+    # Read the diff as yapf produces it, so only one file's diff is held at a
+    # time. stderr goes to a file so that a full pipe can't block yapf.
+    with tempfile.TemporaryFile() as stderr:
+        command = (*_YAPF, '--diff', *files)
+        log_command(command, dict(stdout=subprocess.PIPE, stderr=stderr))
+
+        with subprocess.Popen(command, stdout=subprocess.PIPE,
+                              stderr=stderr) as process:
+            path: Optional[Path] = None
+            lines: List[str] = []
+
+            assert process.stdout is not None
+            for line in process.stdout:
+                start = _DIFF_START.match(line)
+                if start:
+                    add_error(path, lines)
+                    path = Path(start.group(1).decode(errors='replace'))
+                    lines = []
 
-        matches = tuple(_DIFF_START.finditer(raw_diff))
-        for start, end in zip(matches, (*matches[1:], None)):
-            errors[Path(start.group(1))] = colorize_diff(
-                raw_diff[start.start():end.start() if end else None])
+                lines.append(line.decode(errors='replace'))
 
-    if process.stderr:
+            add_error(path, lines)
+
+        stderr.seek(0)
+        error_output = stderr.read()
+
+    if error_output:
         _LOG.error('yapf encountered an error:\n%s',
-                   process.stderr.decode(errors='replace').rstrip())
+                   error_output.decode(errors='replace').rstrip())
         errors.update({file: '' for file in files if file not in errors})
 
     return errors
@@ -202,11 +845,14 @@ def print_format_check(
     # Show a copy-and-pastable command to fix the issues.
     if show_fix_commands:
 
+        cwd = Path.cwd().resolve()
+
         def path_relative_to_cwd(path):
+            resolved = Path(path).resolve()
             try:
-                return Path(path).resolve().relative_to(Path.cwd().resolve())
+                return resolved.relative_to(cwd)
             except ValueError:
-                return Path(path).resolve()
+                return resolved
 
         message = (f'  pw format --fix {path_relative_to_cwd(path)}'
                    for path in errors)
@@ -216,7 +862,7 @@ def print_format_check(
 class CodeFormat(NamedTuple):
     language: str
     extensions: Collection[str]
-    check: Callable[[Iterable], Dict[Path, str]]
+    check: Callable[..., Dict[Path, str]]
     fix: Callable[[Iterable], None]
 
 
@@ -240,12 +886,18 @@ CODE_FORMATS: Sequence[CodeFormat] = (
     PYTHON_FORMAT,
 )
 
+_EXTENSION_TO_FORMAT: Dict[str, CodeFormat] = {
+    extension: code_format
+    for code_format in CODE_FORMATS for extension in code_format.extensions
+}
+
 
 def presubmit_check(code_format: CodeFormat) -> Callable:
     """Creates a presubmit check function from a CodeFormat object."""
     @pw_presubmit.filter_paths(endswith=code_format.extensions)
     def check_code_format(ctx: pw_presubmit.PresubmitContext):
         errors = code_format.check(ctx.paths)
+        _flush_format_caches()
         print_format_check(
             errors,
             # When running as part of presubmit, show the fix command help.
@@ -266,14 +918,18 @@ PRESUBMIT_CHECKS: Sequence[Callable] = tuple(
 
 class CodeFormatter:
     """Checks or fixes the formatting of a set of files."""
-    def __init__(self, files: Sequence[Path]):
+    def __init__(self, files: Sequence[Path], jobs: Optional[int] = None):
         self.paths = list(files)
+        self._jobs = jobs
         self._formats: Dict[CodeFormat, List] = collections.defaultdict(list)
 
         for path in files:
-            for code_format in CODE_FORMATS:
-                if any(str(path).endswith(e) for e in code_format.extensions):
-                    self._formats[code_format].append(path)
+            # splitext finds no extension in names like .gn, which are all
+            # extension, so look those up by their full name.
+            extension = os.path.splitext(path)[1] or os.path.basename(path)
+            code_format = _EXTENSION_TO_FORMAT.get(extension)
+            if code_format:
+                self._formats[code_format].append(path)
 
     def check(self) -> Dict[Path, str]:
         """Returns {path: diff} for files with incorrect formatting."""
@@ -281,9 +937,10 @@ class CodeFormatter:
 
         for code_format, files in self._formats.items():
             _LOG.debug('Checking %s', ', '.join(str(f) for f in files))
-            errors.update(code_format.check(files))
+            errors.update(code_format.check(files, jobs=self._jobs))
 
-        return collections.OrderedDict(sorted(errors.items()))
+        _flush_format_caches()
+        return dict(sorted(errors.items()))
 
     def fix(self) -> None:
         """Fixes format errors for supported files in place."""
@@ -301,9 +958,39 @@ def _file_summary(files: Iterable[Path], base: Path) -> List[str]:
         return []
 
 
-def main(paths: Sequence[Path], exclude, base: str, fix: bool) -> int:
+def _existing_files(paths: Iterable[Path]) -> Set[str]:
+    """Returns the absolute paths of the paths that are files.
+
+    Rather than calling stat on each path, this lists each directory once.
+    """
+    is_file: Dict[str, bool] = {}
+    listed_directories: Set[str] = set()
+    files: Set[str] = set()
+
+    for path in map(os.path.abspath, paths):
+        directory = os.path.dirname(path)
+        if directory not in listed_directories:
+            listed_directories.add(directory)
+            try:
+                with os.scandir(directory) as entries:
+                    is_file.update(
+                        (entry.path, entry.is_file()) for entry in entries)
+            except OSError:
+                pass
+
+        if is_file.get(path):
+            files.add(path)
+
+    return files
+
+
+def main(paths: Sequence[Path],
+         exclude,
+         base: str,
+         fix: bool,
+         jobs: Optional[int] = None) -> int:
     """Checks or fixes formatting for files in a Git repo."""
-    files = [path.resolve() for path in paths if path.is_file()]
+    file_names = _existing_files(paths)
 
     # If this is a Git repo, list the original paths with git ls-files or diff.
     if pw_presubmit.is_git_repo():
@@ -316,13 +1003,21 @@ def main(paths: Sequence[Path], exclude, base: str, fix: bool) -> int:
                 Path.cwd().relative_to(repo), repo)
 
         # Add files from Git and remove duplicates.
-        files = sorted(set(list_git_files(base, paths, exclude)) | set(files))
+        file_names.update(
+            map(
+                str,
+                list_git_files(base,
+                               paths,
+                               exclude,
+                               endswith=tuple(_EXTENSION_TO_FORMAT))))
     elif base:
         _LOG.critical(
             'A base commit may only be provided if running from a Git repo')
         return 1
 
-    formatter = CodeFormatter(files)
+    files = [Path(name) for name in sorted(file_names)]
+
+    formatter = CodeFormatter(files, jobs)
 
     _LOG.info('Checking formatting for %s', plural(formatter.paths, 'file'))
     _LOG.debug('Files to format:\n%s', '\n'.join(str(f) for f in files))
@@ -348,6 +1043,19 @@ def main(paths: Sequence[Path], exclude, base: str, fix: bool) -> int:
     return 0
 
 
+def _positive_int(arg: str) -> int:
+    try:
+        value = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            f'Must be an integer: {arg!r}') from None
+
+    if value < 1:
+        raise argparse.ArgumentTypeError(f'Must be at least 1: {value}')
+
+    return value
+
+
 def argument_parser(parser=None) -> argparse.ArgumentParser:
     if parser is None:
         parser = argparse.ArgumentParser(description=__doc__)
@@ -357,6 +1065,14 @@ def argument_parser(parser=None) -> argparse.ArgumentParser:
     parser.add_argument('--fix',
                         action='store_true',
                         help='Apply formatting fixes in place.')
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        type=_positive_int,
+        default=_default_jobs(),
+        help=('Number of worker processes that check files in parallel, for '
+              'all formatters. Defaults to the number of CPUs available to '
+              'this process.'))
 
     return parser
 
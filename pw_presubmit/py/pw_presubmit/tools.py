@@ -115,20 +115,29 @@ def list_git_files(
         paths: Sequence[PathOrStr] = (),
         exclude: Sequence = (),
         repo: PathOrStr = '.',
+        endswith: Iterable[str] = (),
 ) -> List[Path]:
     """Lists files with git ls-files or git diff --name-only.
 
+    If endswith is provided, only files with one of those endings are listed.
+
     This function may only be called if repo is or is in a Git repository.
     """
+    endings = _make_tuple(endswith)
 
     if commit:
         files = git_diff_names(commit, paths, repo=repo)
-    else:
+    elif paths or not endings:
         files = _git_ls_files(*paths, repo=repo)
+    else:
+        # Have Git filter the files rather than listing the whole repository.
+        files = _git_ls_files(*(f'*{end}' for end in endings), repo=repo)
+
     return sorted(
         set(
             Path(path) for path in files
-            if not any(exp.search(path) for exp in exclude)))
+            if path.endswith(endings or ('', )) and not any(
+                exp.search(path) for exp in exclude)))
 
 
 def is_git_repo(path='.') -> bool:
@@ -202,6 +211,7 @@ def _box(style, left, middle, right, box=_make_box('><>')) -> str:
 
 class PresubmitFailure(Exception):
     """Optional exception to use for presubmit failures."""
+
     def __init__(self, description: str = '', path=None):
         super().__init__(f'{path}: {description}' if path else description)
 
@@ -287,6 +297,7 @@ def file_summary(paths: Iterable[Path],
 
 class Presubmit:
     """Runs a series of presubmit checks on a list of files."""
+
     def __init__(self, repository_root: Path, output_directory: Path,
                  paths: Sequence[Path]):
         self._repository_root = repository_root
@@ -567,6 +578,7 @@ class _Check:
     This class consolidates the logic for running and logging a presubmit check.
     It also supports filtering the paths passed to the presubmit check.
     """
+
     def __init__(self,
                  check_function: Callable[[PresubmitContext], None],
                  path_filter: _PathFilter = _PathFilter(),
@@ -635,6 +647,7 @@ def filter_paths(endswith: Iterable[str] = (''),
     Returns:
         a wrapped version of the presubmit function
     """
+
     def filter_paths_for_function(function: Callable):
         if len(signature(function).parameters) != 1:
             raise TypeError('Functions wrapped with @filter_paths must take '
@@ -648,11 +661,16 @@ def filter_paths(endswith: Iterable[str] = (''),
     return filter_paths_for_function
 
 
-def log_run(*args, **kwargs) -> subprocess.CompletedProcess:
-    """Logs a command then runs it with subprocess.run."""
+def log_command(args: Sequence, kwargs: Dict[str, Any]) -> None:
+    """Logs a command and its subprocess options at debug level."""
     _LOG.debug('[COMMAND] %s\n%s',
                ', '.join(f'{k}={v}' for k, v in sorted(kwargs.items())),
                ' '.join(shlex.quote(str(arg)) for arg in args))
+
+
+def log_run(*args, **kwargs) -> subprocess.CompletedProcess:
+    """Logs a command then runs it with subprocess.run."""
+    log_command(args, kwargs)
     return subprocess.run(args, **kwargs)
 
 
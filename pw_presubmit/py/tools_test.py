@@ -0,0 +1,91 @@
+# Copyright 2020 The Pigweed Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#     https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+"""Tests for pw_presubmit.tools."""
+
+from pathlib import Path
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from pw_presubmit import tools
+
+
+class TestListGitFiles(unittest.TestCase):
+    """Tests listing files in a Git repository."""
+    def setUp(self):
+        self.repo = Path(tempfile.mkdtemp()).resolve()
+
+        for name in ('.gn', 'BUILD.gn', 'main.py', 'main.cc', 'sub/BUILD.gn',
+                     'sub/module.py', 'sub/module.cc', 'sub/registry'):
+            self.repo.joinpath(name).parent.mkdir(parents=True, exist_ok=True)
+            self.repo.joinpath(name).write_text(f'# {name}\n')
+
+        self._git('init', '--quiet')
+        self._git('add', '.')
+        self._git('commit', '--quiet', '--message', 'Initial commit')
+
+    def tearDown(self):
+        shutil.rmtree(self.repo)
+
+    def _git(self, *args: str) -> None:
+        subprocess.run(('git', '-C', self.repo, '-c', 'user.name=Test', '-c',
+                        'user.email=test@example.com', *args),
+                       check=True)
+
+    def _list(self, **kwargs):
+        return [
+            path.relative_to(self.repo)
+            for path in tools.list_git_files(repo=self.repo, **kwargs)
+        ]
+
+    def test_all_files(self):
+        self.assertEqual(self._list(), [
+            Path('.gn'),
+            Path('BUILD.gn'),
+            Path('main.cc'),
+            Path('main.py'),
+            Path('sub/BUILD.gn'),
+            Path('sub/module.cc'),
+            Path('sub/module.py'),
+            Path('sub/registry'),
+        ])
+
+    def test_endswith_str(self):
+        self.assertEqual(
+            self._list(endswith='.py'),
+            [Path('main.py'), Path('sub/module.py')])
+
+    def test_endswith_includes_root_gn_file(self):
+        self.assertEqual(
+            self._list(endswith=('.gn', '.gni')),
+            [Path('.gn'), Path('BUILD.gn'),
+             Path('sub/BUILD.gn')])
+
+    def test_endswith_with_paths(self):
+        self.assertEqual(
+            self._list(paths=[self.repo / 'sub'], endswith=('.py', '.cc')),
+            [Path('sub/module.cc'),
+             Path('sub/module.py')])
+
+    def test_endswith_with_commit(self):
+        self.repo.joinpath('main.py').write_text('# Changed\n')
+        self.repo.joinpath('sub/module.cc').write_text('// Changed\n')
+
+        self.assertEqual(self._list(commit='HEAD', endswith='.py'),
+                         [Path('main.py')])
+
+
+if __name__ == '__main__':
+    unittest.main()